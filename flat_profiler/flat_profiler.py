@@ -1,16 +1,34 @@
 import functools
+import heapq
+import itertools
 import logging
+import math
+import statistics
 import time
+from array import array
 from collections import defaultdict
 from collections.abc import Callable, Generator
 from operator import itemgetter
-from typing import ParamSpec, Protocol, TypeAlias, TypeVar
+from types import CodeType, MethodType
+from typing import NamedTuple, ParamSpec, Protocol, TypeAlias, TypeVar, cast
 
-from recompyle.rewrite import CallExtras, rewrite_wrap_calls_func
+from flat_profiler.rewrite import CallShape, rewrite_site_calls_func
 
 P = ParamSpec("P")
 T = TypeVar("T")
-TimeDict: TypeAlias = dict[tuple[tuple[int, ...], str, str], list[float]]
+CallKey: TypeAlias = tuple[tuple[int, ...], str, str]
+
+
+class CallStats(NamedTuple):
+    """Running totals of a call, recorded instead of each call time when samples are not kept."""
+
+    total: float
+    calls: int
+
+
+TimeDict: TypeAlias = dict[CallKey, "array | CallStats"]
+
+DEFAULT_TOP_K = 20
 
 
 class ProfilerCallback(Protocol):
@@ -23,43 +41,104 @@ class ProfilerCallback(Protocol):
             total (float): Total execution time of the function.
             limit (float): Time limit configured for the function.
             times (TimeDict): All calls recorded and their execution times. Keys are the call names, while
-                the value is a list of each execution time in the order the calls occurred.
+                the value is an array of floats with each execution time. Times of one callable are in the order
+                its calls occurred, while different callables with the same name at a call site, like lambdas or
+                nested functions created again for each call, have their times grouped one callable after
+                another. The overhead of timing each call, measured once per process, is subtracted from these
+                times. If the profiler does not keep samples the value is instead a CallStats of the total time
+                and count.
             func (Callable): The function the calls were within.
         """
 
 
-def collect_profiling_lines(times: TimeDict) -> Generator[str, None, None]:
-    """Convert call data to readable profiling lines.
+def _call_totals(call_times: array | CallStats) -> tuple[float, int]:
+    """Get the total time and number of calls from recorded times of a call."""
+    if type(call_times) is CallStats:
+        return call_times
+    return sum(call_times), len(call_times)
+
+
+def _fastest_call(call_times: array | CallStats) -> float:
+    """Get the fastest time of a call, or the average time if only totals were recorded."""
+    if type(call_times) is CallStats:
+        return call_times.total / call_times.calls
+    return min(call_times)
+
+
+def _calc_times(times: TimeDict) -> Generator[tuple[CallKey, float, int, float], None, None]:
+    """Get the key, total time, number of calls and average time of each call."""
+    for func_key, call_times in times.items():
+        ttl_time, calls = _call_totals(call_times)
+        yield func_key, ttl_time, calls, ttl_time / calls
+
+
+@functools.lru_cache(maxsize=1024)
+def _call_key_prefix(func_key: CallKey) -> str:
+    """Format the unchanging first line for a call, cached as the same calls are reported on each execution."""
+    ln_range, source, name = func_key
+    return f"{source} | {name} | L{'-'.join(str(ln) for ln in ln_range)}"
+
+
+def collect_profiling_lines(times: TimeDict, top_k: int | None = None) -> Generator[str, None, None]:
+    """Convert call data to readable profiling lines, sorted by highest total time first.
 
     For each call, the first line includes:
     - The call as it appears in the original source.
     - The __qualname__ or __name__ of the call.
     - The source line number the call was on.
+
+    If `top_k` is given only lines for that many calls with the highest total times are returned.
     """
-    calc_times = ((func_key, (s := sum(times)), (ln := len(times)), s / ln) for func_key, times in times.items())
+    calc_times = _calc_times(times)
+    if top_k is None:
+        top_times = sorted(calc_times, key=itemgetter(1), reverse=True)
+    else:
+        top_times = heapq.nlargest(top_k, calc_times, key=itemgetter(1))
     return (
-        (
-            f"{func_key[1]} | {func_key[2]} | L{'-'.join(str(f) for f in func_key[0])}\n"
-            f"  ↪ {ttl_time:.3g}s total, {avg_time:.3g}s avg, {calls} calls"
-        )
-        for func_key, ttl_time, calls, avg_time in sorted(calc_times, key=itemgetter(1), reverse=True)
+        f"{_call_key_prefix(func_key)}\n  ↪ {ttl_time:.3g}s total, {avg_time:.3g}s avg, {calls} calls"
+        for func_key, ttl_time, calls, avg_time in top_times
     )
 
 
-def default_above_log(total: float, limit: float, times: TimeDict, func: Callable) -> None:
-    """Log total time and detailed call details."""
-    log = logging.getLogger(func.__module__)
-    detailstr = "\n".join(collect_profiling_lines(times))
+def default_above_log(
+    total: float,
+    limit: float,
+    times: TimeDict,
+    func: Callable,
+    top_k: int | None = DEFAULT_TOP_K,
+    overhead: float = 0.0,
+    log: logging.Logger | None = None,
+) -> None:
+    """Log total time and detailed call details, for up to `top_k` calls with the highest total times.
+
+    If the wrapper `overhead` subtracted from each call time is significant compared to the fastest call, a note is
+    included that short call times are approximate. Logs to the logger of the function's module if `log` is not given.
+    """
+    if log is None:
+        log = logging.getLogger(func.__module__)
+    detailstr = "\n".join(collect_profiling_lines(times, top_k))
+    if top_k is not None and len(times) > top_k:
+        detailstr += f"\n... {len(times) - top_k} more calls not shown"
+    if overhead and times and overhead > 0.1 * (min(map(_fastest_call, times.values())) + overhead):
+        detailstr += (
+            f"\nNote: {overhead:.3g}s timing overhead per call was subtracted, short call times are approximate"
+        )
     log.warning(f"{func.__qualname__} finished in {total:.3g}s, above limit of {limit:.3g}s\n" + detailstr)
 
 
-def default_below_log(total: float, limit: float, times: TimeDict, func: Callable) -> None:
-    """Log total time without call details."""
-    log = logging.getLogger(func.__module__)
+def default_below_log(
+    total: float, limit: float, times: TimeDict, func: Callable, log: logging.Logger | None = None
+) -> None:
+    """Log total time without call details, to the logger of the function's module if `log` is not given."""
+    if log is None:
+        log = logging.getLogger(func.__module__)
     log_str = f"{func.__qualname__} finished in {total:.3g}s, below limit of {limit:.3g}s"
     log.info(log_str)
 
 
+_TOTAL_ONLY_CALLBACKS: tuple[ProfilerCallback, ...] = (default_below_log,)
+
+
 def _find_name(call: Callable) -> str:
     """Get name of a given callable."""
     try:
@@ -78,6 +157,83 @@ def _find_name(call: Callable) -> str:
         return type(call).__name__
 
 
+# Recorded times of a call site by callable, either every time or a [total, calls] list.
+_SiteTimes: TypeAlias = "defaultdict[Callable, array] | defaultdict[Callable, list[float]]"
+
+_INTERVAL_TOLERANCE = 1e-9
+_CALIBRATION_CALLS = 1000
+
+_SITE_WRAPPER_TEMPLATE = """
+def _record_call_time({params}):
+    _start = _perf()
+    try:
+        return __call({call_args})
+    finally:
+        _end = _perf()
+        {record}
+"""
+
+# Bound methods are stored by their function, so calls on many instances share one entry and keep no instance alive.
+_CALL_KEY = "(__call.__func__ if _type(__call) is _MethodType else __call)"
+_RECORD_SAMPLE = f"_site_times[{_CALL_KEY}].append(_end - _start)"
+_RECORD_STATS = f"_stats = _site_times[{_CALL_KEY}]; _stats[0] += _end - _start; _stats[1] += 1"
+
+
+@functools.cache
+def _compile_site_wrapper(shape: CallShape | None, keep_samples: bool = True) -> CodeType:
+    """Compile a call site wrapper specialized to the shape of the call.
+
+    Wrappers taking the exact args of a call avoid packing them into a tuple and dict on every call. Calls with `*` or
+    `**` unpacking, or with keywords that could shadow names used by the wrapper, get a generic wrapper instead.
+
+    With `keep_samples` each time is appended to an array in `_site_times`, otherwise times are added to the
+    `[total, calls]` list in `_site_times`.
+
+    The compiled code defines `_record_call_time`, and expects `_perf`, `_site_times`, `_MethodType` and `_type` as
+    globals.
+    """
+    if shape is None or any(name.startswith("_") for name in shape[1]):
+        params, call_args = "__call, /, *_args, **_kwargs", "*_args, **_kwargs"
+    else:
+        arg_count, kw_names = shape
+        pos_names = [f"_{i}" for i in range(arg_count)]
+        params = ", ".join(["__call", *pos_names, "/", *(["*", *kw_names] if kw_names else [])])
+        call_args = ", ".join([*pos_names, *(f"{name}={name}" for name in kw_names)])
+    record = _RECORD_SAMPLE if keep_samples else _RECORD_STATS
+    source = _SITE_WRAPPER_TEMPLATE.format(params=params, call_args=call_args, record=record)
+    return compile(source, "<flat_profiler site wrapper>", "exec")
+
+
+def _make_site_wrapper(shape: CallShape | None, site_times: _SiteTimes, keep_samples: bool = True) -> Callable:
+    """Create a call site wrapper that records times into the given dict."""
+    namespace: dict[str, object] = {
+        "_perf": time.perf_counter,
+        "_site_times": site_times,
+        "_MethodType": MethodType,
+        "_type": type,
+    }
+    exec(_compile_site_wrapper(shape, keep_samples), namespace)  # noqa: S102
+    return cast(Callable, namespace["_record_call_time"])
+
+
+def _empty_call() -> None:
+    """Call without any work, for measuring call site wrapper overhead."""
+
+
+@functools.cache
+def _site_overhead() -> float:
+    """Measure the time a call site wrapper records for an empty call.
+
+    Every recorded call time includes this overhead of the wrapper and timer. It is measured once per process, as the
+    median of many calls so that it is not thrown off by interruptions.
+    """
+    site_times: defaultdict[Callable, array] = defaultdict(array("d").__copy__)
+    wrapper = _make_site_wrapper((0, ()), site_times)
+    for _ in range(_CALIBRATION_CALLS):
+        wrapper(_empty_call)
+    return statistics.median(site_times[_empty_call])
+
+
 def flat_profile(
     *,
     time_limit: float,
@@ -87,6 +243,9 @@ def flat_profile(
     blacklist: set[str] | None = None,
     whitelist: set[str] | None = None,
     rewrite_details: dict | None = None,
+    top_k: int | None = DEFAULT_TOP_K,
+    sample_rate: float = 1.0,
+    keep_samples: bool = True,
 ) -> Callable[[Callable[P, T]], Callable[P, T]]:
     """Rewrites target function to record runtime of each call in it.
 
@@ -96,8 +255,8 @@ def flat_profile(
     below the time limit, and if above it will also log the sum of times for each call.
 
     Call times are recorded to a dictionary that is local to the decorated function. Keys are the name of calls, and the
-    values are lists of execution times. This list is cleared after each execution. You can access this dictionary by
-    providing alternative callbacks.
+    values are arrays (`array.array` of floats) of execution times. New arrays are used for each execution. You can
+    access this dictionary by providing alternative callbacks.
 
     Callback parameters include total execution time, time limit, the callable time dictionary, and a reference to the
     decorated function.
@@ -113,59 +272,169 @@ def flat_profile(
         whitelist (set[str] | None): Call names that should be wrapped. Allows wildcards like blacklist.
         rewrite_details (dict | None): If provided the given dict will be updated to store the original function object
             and original/new source in the keys `original_func`, `original_source`, and `new_source`.
+        top_k (int | None): Maximum number of calls the default above callback will log, with the highest total
+            times. Use None to log all calls. Default 20.
+        sample_rate (float): Fraction of executions to record call times for, rounded down to one in every N
+            executions, e.g. 0.1 records every 10th execution and 0.7 every 2nd. Other executions run the original
+            function and only record the total time, with callbacks receiving an empty times dict. Default 1.0 records
+            every execution.
+        keep_samples (bool): Whether to record every call time. If False only a running total and count are kept per
+            call, and callbacks receive a CallStats for each call instead of an array. Default True.
 
     Returns:
         Callable: A decorator that will replace the wrapped function.
     """
     if below_callback is None and above_callback is None:
         raise ValueError("At least one of before_callback and above_callback must be non-None")
+    if not 0 < sample_rate <= 1:
+        raise ValueError("sample_rate must be above 0 and at most 1")
+    if top_k is not None and top_k < 1:
+        raise ValueError("top_k must be None or at least 1")
+
+    # Default callbacks that only log the total are given an empty dict, skipping collection of the times.
+    below_reads_times = below_callback not in _TOTAL_ONLY_CALLBACKS
+    above_reads_times = above_callback not in _TOTAL_ONLY_CALLBACKS
 
-    _call_times: defaultdict[tuple[tuple[int, ...], str, str], list[float]] = defaultdict(list)
+    # Wrapper overhead is subtracted from all recorded call times.
+    overhead = _site_overhead()
+
+    _perf = time.perf_counter  # Bound once so wrappers use a closure cell, not a global and attribute lookup.
     _call_names: dict[object, str] = {}
 
     def _get_name(call: Callable) -> str:
         """Use stored callable name or find if the callable is new."""
-        try:
-            return _call_names[call]
-        except KeyError:
-            pass
-
-        _call_names[call] = _find_name(call)
-        return _call_names[call]
-
-    def _record_call_time(__call: Callable[P, T], __extras: CallExtras, *args: P.args, **kwargs: P.kwargs) -> T:
-        """Wrapper to record execution time of inner calls."""
-        start = time.perf_counter()
-        try:
-            return __call(*args, **kwargs)
-        finally:
-            end = time.perf_counter()
-            _call_times[(__extras["ln_range"], __extras["source"], _get_name(__call))].append(end - start)
+        name = _call_names.get(call)
+        if name is None:
+            name = _call_names[call] = _find_name(call)
+        return name
 
     def _measure_calls(func: Callable[P, T]) -> Callable[P, T]:
         """Decorator to measure total call time and inner call times."""
-        _new_func = rewrite_wrap_calls_func(
+        _sites: list[tuple[tuple[int, ...], str, _SiteTimes, dict[str, CallKey]]] = []
+
+        def _site_wrapper(ln_range: tuple[int, ...], source: str, shape: CallShape | None) -> Callable:
+            """Create wrapper to record execution time of calls at one call site."""
+            # Times are stored by callable, names are only found when times are collected for a callback. Arrays store
+            # times as C doubles rather than a float object per recorded time. Copying an empty array is the cheapest
+            # way to create new ones.
+            site_times: _SiteTimes
+            if keep_samples:
+                site_times = defaultdict(array("d").__copy__)
+            else:
+                site_times = defaultdict([0.0, 0].copy)
+            # Keys are made once per name found at the site, and reused each time times are collected.
+            _sites.append((ln_range, source, site_times, {}))
+            return _make_site_wrapper(shape, site_times, keep_samples)
+
+        def _pop_times(collect: bool = True) -> TimeDict:
+            """Collect recorded times of all call sites if needed, and reset sites for the next execution."""
+            times: TimeDict = {}
+            for ln_range, source, site_times, site_keys in _sites:
+                if collect:
+                    for call, raw_times in site_times.items():
+                        call_times: array | CallStats
+                        if keep_samples:
+                            call_times = array("d", [t - overhead if t > overhead else 0.0 for t in raw_times])
+                        else:
+                            ttl_time, calls = raw_times
+                            call_times = CallStats(max(ttl_time - overhead * calls, 0.0), calls)
+                        name = _get_name(call)
+                        key = site_keys.get(name)
+                        if key is None:
+                            key = site_keys[name] = (ln_range, source, name)
+                        if key in times:
+                            # Different callables with the same name at one site, e.g. methods of separate instances.
+                            if keep_samples:
+                                times[key].extend(call_times)
+                            else:
+                                prev = times[key]
+                                times[key] = CallStats(prev.total + call_times.total, prev.calls + call_times.calls)
+                        else:
+                            times[key] = call_times
+                site_times.clear()
+            return times
+
+        _new_func = rewrite_site_calls_func(
             target_func=func,
-            wrapper=_record_call_time,
+            site_factory=_site_wrapper,
             ignore_builtins=ignore_builtins,
             blacklist=blacklist,
             whitelist=whitelist,
             rewrite_details=rewrite_details,
         )
 
-        @functools.wraps(func)
-        def inner_wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
-            start = time.perf_counter()
-            try:
-                return _new_func(*args, **kwargs)
-            finally:
-                duration = time.perf_counter() - start
-                if below_callback is not None and duration < time_limit:
-                    below_callback(duration, time_limit, _call_times.copy(), _new_func)
-                elif above_callback is not None and duration >= time_limit:
-                    above_callback(duration, time_limit, _call_times.copy(), _new_func)
-                _call_times.clear()
-
+        # Choose which function each execution runs, when sampling only every Nth runs the rewritten function. Rates
+        # like 1/49 give a reciprocal just above N from float rounding, which must not round up to the next interval.
+        interval = math.ceil(1 / sample_rate - _INTERVAL_TOLERANCE)
+        if interval == 1:
+            _next_func = itertools.repeat(_new_func).__next__
+        else:
+            countdown = 0
+
+            def _next_func() -> Callable[P, T]:
+                """Count down executions of the original function until the next recorded one."""
+                nonlocal countdown
+                if countdown:
+                    countdown -= 1
+                    return func
+                countdown = interval - 1
+                return _new_func
+
+        # Default callbacks are given the logger of func now, rather than getting it on every execution.
+        log = logging.getLogger(func.__module__)
+        below, above = below_callback, above_callback
+        if below is default_below_log:
+            below = functools.partial(default_below_log, log=log)
+        if above is default_above_log:
+            above = functools.partial(default_above_log, top_k=top_k, overhead=overhead, log=log)
+
+        # Select a wrapper at decoration time so unused callbacks add no checks to each execution.
+        if above is None:
+
+            def inner_wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+                start = _perf()
+                try:
+                    return _next_func()(*args, **kwargs)
+                finally:
+                    duration = _perf() - start
+                    if duration < time_limit:
+                        below(duration, time_limit, _pop_times(below_reads_times), _new_func)
+                    else:
+                        _pop_times(collect=False)
+
+        elif below is None:
+
+            def inner_wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+                start = _perf()
+                try:
+                    return _next_func()(*args, **kwargs)
+                finally:
+                    duration = _perf() - start
+                    if duration >= time_limit:
+                        above(duration, time_limit, _pop_times(above_reads_times), _new_func)
+                    else:
+                        _pop_times(collect=False)
+
+        else:
+
+            def inner_wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+                start = _perf()
+                try:
+                    return _next_func()(*args, **kwargs)
+                finally:
+                    duration = _perf() - start
+                    if duration < time_limit:
+                        below(duration, time_limit, _pop_times(below_reads_times), _new_func)
+                    else:
+                        above(duration, time_limit, _pop_times(above_reads_times), _new_func)
+
+        # Set only the attributes needed to stand in for func, rather than also copying its __dict__ and annotations.
+        # Signature inspection still works through __wrapped__.
+        inner_wrapper.__module__ = func.__module__
+        inner_wrapper.__name__ = func.__name__
+        inner_wrapper.__qualname__ = func.__qualname__
+        inner_wrapper.__doc__ = func.__doc__
+        inner_wrapper.__wrapped__ = func  # type: ignore[attr-defined]
         return inner_wrapper
 
     return _measure_calls
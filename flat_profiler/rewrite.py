@@ -0,0 +1,191 @@
+import ast
+import inspect
+from collections.abc import Callable
+from typing import ParamSpec, Protocol, TypeAlias, TypeVar, cast
+
+# These are recompyle internals, along with private attributes of WrapCallsTransformer used below, so the dependency is
+# pinned to an exact version in pyproject.toml.
+from recompyle.rewrite.rewrite_function import ALREADY_RECOMPYLED, rewrite_function
+from recompyle.transformers import WrapCallsTransformer
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+WRAP_NAME = "_flat_profiler_wrap"
+
+CallShape: TypeAlias = tuple[int, tuple[str, ...]]
+
+
+class SiteWrapperFactory(Protocol):
+    """Site wrapper factory protocol."""
+
+    def __call__(self, ln_range: tuple[int, ...], source: str, shape: CallShape | None) -> Callable:
+        """Create the wrapper for a single call site.
+
+        The returned wrapper is called as `wrapper(__call, *args, **kwargs)` and must return the result of
+        `__call(*args, **kwargs)`.
+
+        Args:
+            ln_range (tuple[int, ...]): Line range of the call source.
+            source (str): Source code of the call.
+            shape (CallShape | None): Count of positional args and names of keyword args the call is always made
+                with, or None if the call unpacks args or kwargs with `*` or `**`.
+        """
+
+
+class SiteWrapCallsTransformer(WrapCallsTransformer):
+    """Transforms a function AST by wrapping every call with a wrapper made for that call site.
+
+    Recompyle's transformer passes the same wrapper a dict of call details on every call. Here the details are given
+    to `site_factory` once per call site when the AST is transformed, and each call is rewritten to use its own
+    wrapper. Each wrapper is stored in `site_locals` under a unique name, which is added as a keyword-only parameter of
+    the function with that wrapper as the default, so calls load their wrapper as a fast local.
+    """
+
+    def __init__(
+        self,
+        wrap_call_name: str,
+        site_factory: SiteWrapperFactory,
+        site_locals: dict[str, object],
+        blacklist: set[str] | None = None,
+        whitelist: set[str] | None = None,
+        initial_line: int = 0,
+    ):
+        """Store `site_factory` for creating wrappers.
+
+        Args:
+            wrap_call_name (str): Name prefix of site wrappers.
+            site_factory (SiteWrapperFactory): Creates the wrapper for each call site.
+            site_locals (dict[str, object]): Locals the function will be executed with, wrappers are added to it.
+            blacklist (set[str] | None): Optional call names that should not be wrapped.
+            whitelist (set[str] | None): Optional call names that should be wrapped.
+            initial_line (int): Starting source line number of the wrapped function.
+        """
+        super().__init__(wrap_call_name, blacklist=blacklist, whitelist=whitelist, initial_line=initial_line)
+        self.site_factory = site_factory
+        self.site_locals = site_locals
+        self.site_names: list[str] = []
+        self._in_function = False
+
+    @staticmethod
+    def _call_shape(node: ast.Call) -> CallShape | None:
+        """Get the positional arg count and keyword names of a call, if they are fixed.
+
+        Args:
+            node (Call): Call node to check.
+
+        Returns:
+            CallShape | None: Arg count and keyword names, or None if the call uses `*` or `**` unpacking.
+        """
+        if any(isinstance(arg, ast.Starred) for arg in node.args) or any(kw.arg is None for kw in node.keywords):
+            return None
+        return len(node.args), tuple(cast(str, kw.arg) for kw in node.keywords)
+
+    def visit_Call(self, node: ast.Call) -> ast.Call:
+        """Wrap every call node that is not ignored with the wrapper of its call site.
+
+        Args:
+            node (Call): Call definition to wrap.
+
+        Returns:
+            Call: Node after changes.
+        """
+        if self._allow_wrap_call(node):
+            start, end, i = node.lineno, node.end_lineno, self._initial_line
+            ln_range = (start + i, end + i) if end is not None and end != start else (start + i,)
+            site_name = f"{self._wrap_call_name}_{len(self.site_names)}"
+            self.site_locals[site_name] = self.site_factory(ln_range, ast.unparse(node), self._call_shape(node))
+            self.site_names.append(site_name)
+            new_node = ast.Call(ast.Name(site_name, ast.Load()), args=[node.func, *node.args], keywords=node.keywords)
+            ast.copy_location(new_node, node)
+        else:
+            new_node = node
+
+        self.generic_visit(new_node)
+        return new_node
+
+    def visit_FunctionDef(self, node: ast.FunctionDef) -> ast.FunctionDef:
+        """Add the wrapper of each call site as a keyword-only param of the target function.
+
+        Nested functions are left with their decorators and access the wrappers through their closure.
+
+        Args:
+            node (FunctionDef): Function definition node to modify.
+
+        Returns:
+            ast.FunctionDef: Node after changes.
+        """
+        if self._in_function:
+            self.generic_visit(node)
+            return node
+
+        # Remove decorators. The transformed version should have none, as it will be passed into the actual
+        # decorators after compiling.
+        node.decorator_list = []
+        self._in_function = True
+        self.generic_visit(node)
+        for site_name in self.site_names:
+            node.args.kwonlyargs.append(ast.arg(site_name))
+            node.args.kw_defaults.append(ast.Name(id=site_name, ctx=ast.Load()))
+        return node
+
+
+def rewrite_site_calls_func(
+    *,
+    target_func: Callable[P, T],
+    site_factory: SiteWrapperFactory,
+    ignore_builtins: bool = False,
+    blacklist: set[str] | None = None,
+    whitelist: set[str] | None = None,
+    rewrite_details: dict[str, object] | None = None,
+) -> Callable[P, T]:
+    """Rewrites the target function so that every call is passed through a wrapper specific to its call site.
+
+    Equivalent to `recompyle.rewrite.rewrite_wrap_calls_func`, except `site_factory` is called once for each call site
+    found during the rewrite, rather than passing the details of the call site to a shared wrapper on every call.
+
+    Args:
+        target_func (Callable): The function/method to rewrite.
+        site_factory (SiteWrapperFactory): Creates the wrapper for each call site.
+        ignore_builtins (bool): Whether to skip wrapping builtin calls.
+        blacklist (set[str] | None): Call names that should not be wrapped.
+        whitelist (set[str] | None): Call names that should be wrapped.
+        rewrite_details (dict[str, object]): If provided will be updated to store the original function object and
+            original/new source in the keys `"original_func"`, `"original_source"`, and `"new_source"`.
+
+    Returns:
+        Callable: Rewritten function with calls wrapped.
+    """
+    func_file = inspect.getsourcefile(target_func.__code__)
+    if func_file is None:
+        raise ValueError(f"Source not available for {target_func.__qualname__}")
+
+    func_id = f"{func_file}:{target_func.__qualname__}"
+    if func_id in ALREADY_RECOMPYLED:
+        raise ValueError("Multiple recompyle runs on same function not supported")
+
+    # Combine blacklist with builtins if needed, without modifying the given blacklist.
+    full_blacklist = blacklist
+    if ignore_builtins:
+        builtin_calls = {key for key, value in target_func.__builtins__.items() if isinstance(value, Callable)}
+        full_blacklist = builtin_calls if blacklist is None else blacklist | builtin_calls
+
+    # Wrappers are added to the locals during the transform, before the rewritten function is executed.
+    custom_locals: dict[str, object] = {}
+    transformer = SiteWrapCallsTransformer(
+        WRAP_NAME,
+        site_factory,
+        custom_locals,
+        blacklist=full_blacklist,
+        whitelist=whitelist,
+        initial_line=target_func.__code__.co_firstlineno - 1,
+    )
+
+    result = rewrite_function(
+        target_func=target_func,
+        transformers=[transformer],
+        custom_locals=custom_locals,
+        rewrite_details=rewrite_details,
+    )
+    ALREADY_RECOMPYLED.add(func_id)
+    return result
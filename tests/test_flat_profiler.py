@@ -1,11 +1,21 @@
+import functools
 import logging
 import time
+from array import array
+from collections import defaultdict
 from collections.abc import Callable
 
 import pytest
 
+import flat_profiler.flat_profiler
 from flat_profiler import flat_profile
-from flat_profiler.flat_profiler import TimeDict
+from flat_profiler.flat_profiler import (
+    CallStats,
+    TimeDict,
+    _make_site_wrapper,
+    collect_profiling_lines,
+    default_above_log,
+)
 
 last_total: float = None
 last_limit: float = None
@@ -60,6 +70,84 @@ def default_callbacks(delay_time: float):
     return sum(int(x) for x in range(3))
 
 
+def echo_args(*args, **kwargs):
+    return args, kwargs
+
+
+@flat_profile(time_limit=10, below_callback=get_args, above_callback=None)
+def call_shapes(args: tuple, kwargs: dict):
+    return [
+        echo_args(),
+        echo_args(1, 2),
+        echo_args(1, key=2),
+        echo_args(*args, **kwargs),
+        echo_args(_0=1, start=2, __call=3),
+        echo_args(type=1),
+    ]
+
+
+@flat_profile(time_limit=0, ignore_builtins=False, top_k=1)
+def top_k_calls(delay_time: float):
+    delay_func(delay_time)
+    return sum(int(x) for x in range(3))
+
+
+@flat_profile(time_limit=10, below_callback=get_args, above_callback=None)
+def nested_calls(value: int):
+    @functools.cache
+    def nested(inner: int):
+        return echo_args(inner)
+
+    apply = lambda inner: nested(inner)  # noqa: E731
+    return apply(value), nested.cache_info().misses
+
+
+@flat_profile(time_limit=10, below_callback=get_args, above_callback=None, sample_rate=0.5)
+def sampled_calls(value: int):
+    return echo_args(value)
+
+
+@flat_profile(time_limit=10, below_callback=get_args, above_callback=None, sample_rate=0.7)
+def rounded_sampled_calls(value: int):
+    return echo_args(value)
+
+
+@flat_profile(time_limit=10, below_callback=get_args, above_callback=None, sample_rate=1e-9)
+def rare_sampled_calls(value: int):
+    return echo_args(value)
+
+
+@flat_profile(time_limit=10, below_callback=get_args, above_callback=None, sample_rate=1 / 49)
+def reciprocal_sampled_calls(value: int):
+    return echo_args(value)
+
+
+def overhead_calls(delay_time: float):
+    delay_func(delay_time)
+    return echo_args()
+
+
+def overhead_note_calls():
+    return echo_args()
+
+
+class Item:
+    def process(self):
+        return 1
+
+
+@flat_profile(time_limit=10, below_callback=get_args, above_callback=None)
+def instance_calls(items: list[Item]):
+    return [item.process() for item in items]
+
+
+@flat_profile(time_limit=10, below_callback=get_args, above_callback=None, keep_samples=False)
+def stats_calls(items: list[Item]):
+    for item in items:
+        item.process()
+    return echo_args(len(items))
+
+
 @pytest.mark.usefixtures("_wipe_args")
 class TestFlatProfiler:
     def verify_callback_args(self, func_name, limit):
@@ -129,3 +217,133 @@ class TestFlatProfiler:
         assert len(caplog.records) == 1
         assert "above limit" in caplog.records[0].message
         assert "delay_func" in caplog.records[0].message  # Log has call info.
+
+    def test_default_above_top_k(self, caplog):
+        """Default above callback only logs the calls with the highest total times."""
+        with caplog.at_level(logging.INFO):
+            assert top_k_calls(delay_time=0.01) == 3
+        assert len(caplog.records) == 1
+        message = caplog.records[0].message
+        assert "delay_func" in message
+        assert "int(x)" not in message
+        assert "3 more calls not shown" in message
+
+    def test_top_k_invalid(self):
+        """Top k must be None or a positive number of calls."""
+        with pytest.raises(ValueError, match="top_k"):
+            flat_profile(time_limit=1, top_k=0)
+        with pytest.raises(ValueError, match="top_k"):
+            flat_profile(time_limit=1, top_k=-1)
+        flat_profile(time_limit=1, top_k=None)
+
+    def test_call_shapes(self):
+        """Calls are passed their args unchanged regardless of how they are made."""
+        assert call_shapes((1,), {"a": 2}) == [
+            ((), {}),
+            ((1, 2), {}),
+            ((1,), {"key": 2}),
+            ((1,), {"a": 2}),
+            ((), {"_0": 1, "start": 2, "__call": 3}),
+            ((), {"type": 1}),
+        ]
+        assert len(last_times) == 6
+        assert all(len(times) == 1 for times in last_times.values())
+
+    def test_instance_calls(self):
+        """Methods of different instances called at the same call site are recorded together."""
+        assert instance_calls([Item(), Item(), Item()]) == [1, 1, 1]
+        assert len(last_times) == 1
+        ((_, source, name), times) = last_times.popitem()
+        assert source == "item.process()"
+        assert name == "Item.process"
+        assert len(times) == 3
+
+    def test_instance_calls_single_entry(self):
+        """Bound methods of many instances are stored in a single entry of the call site."""
+        site_times = defaultdict(array("d").__copy__)
+        wrapper = _make_site_wrapper((0, ()), site_times)
+        for item in [Item() for _ in range(100)]:
+            assert wrapper(item.process) == 1
+        assert list(site_times) == [Item.process]
+        assert len(site_times[Item.process]) == 100
+
+    def test_wrapper_attributes(self):
+        """Decorated function keeps the identifying attributes of the original."""
+        assert custom_below_callback.__name__ == "custom_below_callback"
+        assert custom_below_callback.__qualname__ == "custom_below_callback"
+        assert custom_below_callback.__module__ == __name__
+        assert custom_below_callback.__wrapped__.__name__ == "custom_below_callback"
+
+    def test_nested_calls(self):
+        """Calls in nested functions are recorded, and nested functions keep their decorators."""
+        assert nested_calls(1) == (((1,), {}), 1)
+        names = {name for _, _, name in last_times}
+        assert {"echo_args", "nested_calls.<locals>.nested", "nested_calls.<locals>.<lambda>"} <= names
+
+    def test_sample_rate(self):
+        """Only sampled executions record call times, but all run callbacks."""
+        recorded = []
+        for value in range(4):
+            assert sampled_calls(value) == ((value,), {})
+            recorded.append(len(last_times))
+        assert recorded == [1, 0, 1, 0]
+
+    def test_sample_rate_rounding(self):
+        """Sample rates round down to every Nth execution, and small rates need no storage per execution."""
+        recorded = []
+        for value in range(4):
+            assert rounded_sampled_calls(value) == ((value,), {})
+            recorded.append(len(last_times))
+        assert recorded == [1, 0, 1, 0]
+        recorded = []
+        for value in range(3):
+            assert rare_sampled_calls(value) == ((value,), {})
+            recorded.append(len(last_times))
+        assert recorded == [1, 0, 0]
+        recorded = []
+        for value in range(50):
+            assert reciprocal_sampled_calls(value) == ((value,), {})
+            recorded.append(len(last_times))
+        assert [i for i, count in enumerate(recorded) if count] == [0, 49]
+
+    def test_sample_rate_invalid(self):
+        """Sample rate must be a fraction of executions."""
+        with pytest.raises(ValueError, match="sample_rate"):
+            flat_profile(time_limit=1, sample_rate=0)
+        with pytest.raises(ValueError, match="sample_rate"):
+            flat_profile(time_limit=1, sample_rate=2)
+
+    def test_keep_samples_false(self):
+        """Without samples each call is recorded as a total time and count."""
+        assert stats_calls([Item(), Item(), Item()]) == ((3,), {})
+        stats = {name: times for (_, _, name), times in last_times.items()}
+        assert set(stats) == {"Item.process", "echo_args"}
+        assert all(type(times) is CallStats and times.total >= 0 for times in stats.values())
+        assert stats["Item.process"].calls == 3
+        assert stats["echo_args"].calls == 1
+        lines = list(collect_profiling_lines(last_times))
+        assert len(lines) == 2
+        assert any("3 calls" in line for line in lines)
+
+    def test_overhead_subtracted(self, monkeypatch):
+        """Wrapper overhead is subtracted from call times, and times shorter than it are clamped to zero."""
+        monkeypatch.setattr(flat_profiler.flat_profiler, "_site_overhead", lambda: 0.005)
+        profiled = flat_profile(time_limit=10, below_callback=get_args, above_callback=None)(overhead_calls)
+        assert profiled(0.02) == ((), {})
+        times = {name: call_times for (_, _, name), call_times in last_times.items()}
+        assert 0.015 <= times["delay_func"][0] <= last_total - 0.005
+        assert list(times["echo_args"]) == [0.0]
+
+    def test_overhead_note(self, monkeypatch, caplog):
+        """Default above callback notes when the subtracted overhead is significant compared to the fastest call."""
+        monkeypatch.setattr(flat_profiler.flat_profiler, "_site_overhead", lambda: 0.005)
+        profiled = flat_profile(time_limit=0)(overhead_note_calls)
+        with caplog.at_level(logging.INFO):
+            profiled()
+        assert "Note: 0.005s timing overhead per call was subtracted" in caplog.records[0].message
+
+        caplog.clear()
+        times = {((1,), "delay_func(delay_time)", "delay_func"): array("d", [0.1])}
+        with caplog.at_level(logging.INFO):
+            default_above_log(0.1, 0, times, overhead_calls, overhead=0.005)
+        assert "Note:" not in caplog.records[0].message